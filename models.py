@@ -1,5 +1,7 @@
+import numpy as np
 
 import nn
+import nn_kernels
 
 
 class PerceptronModel(object):
@@ -42,20 +44,48 @@ class PerceptronModel(object):
         else:
             return -1
 
+    def _misclassified(self, x, y, start, stop=None):
+        """
+        Returns the indices, relative to `start`, of the points in
+        x[start:stop] that the current weights misclassify.
+        """
+        # A point is misclassified when the sign of its score (with 0 counting
+        # as positive, as in get_prediction) disagrees with the sign of its
+        # label
+        scores = np.dot(x.data[start:stop], self.w.data.T)
+        return np.flatnonzero((scores >= 0.0) != (y.data[start:stop] > 0))
+
     def train(self, dataset):
         """
         Train the perceptron until convergence.
         """
-        count = 1
-        while count != 0:
-            count = 0
-            for data in dataset.iterate_once(1):
-                if self.get_prediction(data[0]) == -1 and nn.as_scalar(data[1]) == 1:
-                    count += 1
-                    nn.Parameter.update(self.w, data[0], 1)
-                elif self.get_prediction(data[0]) == 1 and nn.as_scalar(data[1]) == -1:
-                    count += 1
-                    nn.Parameter.update(self.w, data[0], -1)
+        # Number of points scored at once while looking for the next mistake
+        block = 64
+        converged = False
+        while not converged:
+            converged = True
+            for x, y in dataset.iterate_once(dataset.x.shape[0]):
+                # Score the points a block at a time and jump straight to the
+                # first misclassified one. Points before it were scored with
+                # the current weights, so this makes exactly the same updates
+                # as visiting the points one at a time. Scoring blocks rather
+                # than the whole rest of the data bounds the work per update.
+                start = 0
+                unchecked = 0
+                while start < x.data.shape[0]:
+                    wrong = self._misclassified(x, y, start, start + block)
+                    if wrong.size == 0:
+                        start += block
+                        continue
+                    i = start + wrong[0]
+                    self.w.update(nn.Constant(x.data[i:i + 1]), float(y.data[i, 0]))
+                    start = unchecked = i + 1
+
+                # Everything from `unchecked` on is correct under the final
+                # weights. If the points before it are too, another epoch
+                # would not make any updates, so there is no need to run it.
+                converged = converged and (
+                    self._misclassified(x, y, 0, unchecked).size == 0)
 
 
 class RegressionModel(object):
@@ -71,9 +101,28 @@ class RegressionModel(object):
 
         self.w_2 = nn.Parameter(400, 1)
         self.b_2 = nn.Parameter(1, 1)
-
-        self.batch_size = 0
-        self.alpha = -0.01
+        self._params = (self.w_1, self.b_1, self.w_2, self.b_2)
+
+        # Several steps per epoch over the 200 points: a full batch gives one
+        # update per epoch and needs thousands of epochs to converge
+        self.batch_size = 20
+        self.alpha = -0.02
+
+        # The training graph is built once on placeholders and re-run on each
+        # batch with nn.run_and_backprop. Its hidden layer writes into these
+        # buffers, so training steps do not allocate a new (batch_size x 400)
+        # array each time.
+        self._h1 = np.empty((self.batch_size, 400))
+        self._mask = np.empty(self._h1.shape, dtype=bool)
+        self._x = nn.Placeholder(np.zeros((self.batch_size, 1)))
+        self._y = nn.Placeholder(np.zeros((self.batch_size, 1)))
+        self._loss_scalar = np.empty((), dtype=np.float64)
+        self._loss = nn.SquareLoss(
+            self._run(self._x, out=self._h1, mask=self._mask), self._y,
+            out=self._loss_scalar)
+        # Sum of the batch losses over an epoch, only converted to a Python
+        # number once the epoch is over
+        self._loss_sum = np.zeros(())
 
     def run(self, x):
         """
@@ -84,14 +133,17 @@ class RegressionModel(object):
         Returns:
             A node with shape (batch_size x 1) containing predicted y-values
         """
-        if self.batch_size == 0:
-            self.batch_size = x.data.shape[0]
+        return self._run(x)
 
-        first_bias = nn.ReLU(nn.AddBias(nn.Linear(x, self.w_1), self.b_1))
+    def _run(self, x, out=None, mask=None):
+        # `out` and `mask` are passed on to nn.LinearBiasReLU; only the
+        # training graph built in __init__ uses them
+        first_bias = nn.LinearBiasReLU(
+            x, self.w_1, self.b_1, out=out, mask=mask)
 
         return nn.AddBias(nn.Linear(first_bias, self.w_2), self.b_2)
 
-    def get_loss(self, x, y):
+    def get_loss(self, x, y, out=None):
         """
         Computes the loss for a batch of examples.
 
@@ -99,24 +151,26 @@ class RegressionModel(object):
             x: a node with shape (batch_size x 1)
             y: a node with shape (batch_size x 1), containing the true y-values
                 to be used for training
+            out: optional 0-dimensional array for the loss value (see
+                nn.SquareLoss)
         Returns: a loss node
         """
-        return nn.SquareLoss(self.run(x), y)
+        return nn.SquareLoss(self.run(x), y, out=out)
 
     def train(self, dataset):
         """
         Trains the model.
         """
         while True:
-            losses = 0
+            self._loss_sum[...] = 0.0
             for x,y in dataset.iterate_once(self.batch_size):
-                loss = self.get_loss(x, y)
-                losses += nn.as_scalar(loss)
-                origin = [self.w_1, self.b_1, self.w_2, self.b_2]
-                gradient = nn.gradients(loss, origin)
-                for i in range(len(origin)):
-                    origin[i].update(gradient[i], self.alpha)
-            if losses / dataset.x.shape[0] < 0.02:
+                self._x.data = x.data
+                self._y.data = y.data
+                gradient = nn.run_and_backprop(self._loss, self._params)
+                self._loss_sum += self._loss.data
+                nn.Parameter.batch_update(self._params, gradient, self.alpha)
+            mean_loss = float(self._loss_sum) * self.batch_size / dataset.x.shape[0]
+            if mean_loss < 0.02:
                 break
 
 
@@ -143,11 +197,36 @@ class DigitClassificationModel(object):
         # w_2 is second layer neurons 1-100 in hidden layer to neurons 1-10 in output layer
         self.w_2 = nn.Parameter(100, 10)
         self.b_2 = nn.Parameter(1, 10)
-
-        self.batch_size = 5
-
-        # alpha or learning rate
-        self.alpha = -0.01
+        self._params = (self.w_1, self.b_1, self.w_2, self.b_2)
+
+        # Large enough batches that the matmuls, not the per-step Python
+        # overhead, dominate a training step. It has to divide the 60000
+        # training images.
+        self.batch_size = 200
+
+        # alpha or learning rate. SoftmaxLoss averages over the batch, so this
+        # is scaled up with the batch size to keep the same step per sample.
+        self.alpha = -0.4
+
+        # Number of training steps between validation checks, so that training
+        # can stop partway through an epoch (an epoch is 300 steps)
+        self.validation_interval = 100
+
+        # With Numba available, train() computes the gradients with a single
+        # compiled kernel that writes into these buffers, instead of building
+        # and backpropagating through a graph for every batch
+        self._train_step = (
+            nn_kernels.mlp_softmax_gradients if nn_kernels.enabled else None)
+        self._gradients = tuple(
+            nn.Constant(np.zeros_like(param.data)) for param in self._params)
+
+        # Otherwise the training graph is built once on placeholders and re-run
+        # on each batch with nn.run_and_backprop
+        if self._train_step is None:
+            self._x = nn.Placeholder(np.zeros((self.batch_size, 784)))
+            self._y = nn.Placeholder(np.full((self.batch_size, 10), 0.1))
+            self._loss_scalar = np.empty((), dtype=np.float64)
+            self._loss = self.get_loss(self._x, self._y, out=self._loss_scalar)
 
     def run(self, x):
         """
@@ -163,11 +242,11 @@ class DigitClassificationModel(object):
             A node with shape (batch_size x 10) containing predicted scores
                 (also called logits)
         """
-        first_bias = nn.ReLU(nn.AddBias(nn.Linear(x, self.w_1), self.b_1))
+        first_bias = nn.LinearBiasReLU(x, self.w_1, self.b_1)
 
         return nn.AddBias(nn.Linear(first_bias, self.w_2), self.b_2)
 
-    def get_loss(self, x, y):
+    def get_loss(self, x, y, out=None):
         """
         Computes the loss for a batch of examples.
 
@@ -178,23 +257,35 @@ class DigitClassificationModel(object):
         Inputs:
             x: a node with shape (batch_size x 784)
             y: a node with shape (batch_size x 10)
+            out: optional 0-dimensional array for the loss value (see
+                nn.SoftmaxLoss)
         Returns: a loss node
         """
-        return nn.SoftmaxLoss(self.run(x), y)
+        return nn.SoftmaxLoss(self.run(x), y, out=out)
 
     def train(self, dataset):
         """
         Trains the model.
         """
+        step = 0
         while True:
             for x, y in dataset.iterate_once(self.batch_size):
-                loss = self.get_loss(x, y)
-                origin = [self.w_1, self.b_1, self.w_2, self.b_2]
-                gradient = nn.gradients(loss, origin)
-                for i in range(len(origin)):
-                    origin[i].update(gradient[i], self.alpha)
-            if dataset.get_validation_accuracy() >= 0.975:
-                break
+                if self._train_step is not None:
+                    self._train_step(
+                        np.ascontiguousarray(x.data, dtype=np.float64),
+                        np.ascontiguousarray(y.data, dtype=np.float64),
+                        *(param.data for param in self._params),
+                        *(grad.data for grad in self._gradients))
+                    gradient = self._gradients
+                else:
+                    self._x.data = x.data
+                    self._y.data = y.data
+                    gradient = nn.run_and_backprop(self._loss, self._params)
+                nn.Parameter.batch_update(self._params, gradient, self.alpha)
+                step += 1
+                if (step % self.validation_interval == 0
+                        and dataset.get_validation_accuracy() >= 0.975):
+                    return
 
 
 class LanguageIDModel(object):
@@ -214,11 +305,23 @@ class LanguageIDModel(object):
         self.languages = ["English", "Spanish", "Finnish", "Dutch", "Polish"]
 
         # Initialize your model parameters here
-        self.batch_size = 0
-        self.alpha = -0.01
-        self.w_1 = nn.Parameter(self.num_chars, 100)
-        self.w_2 = nn.Parameter(100, 100)
-        self.w_3 = nn.Parameter(100, len(self.languages))
+        self.batch_size = 64
+        self.alpha = -0.1
+        self.hidden_size = 100
+        # Number of training steps between validation checks, so that training
+        # can stop partway through an epoch
+        self.validation_interval = 100
+        # w_1 stacks the input-to-hidden weights (first num_chars rows) on top
+        # of the hidden-to-hidden weights, as nn.RecurrentReLU expects
+        self.w_1 = nn.Parameter(self.num_chars + self.hidden_size, self.hidden_size)
+        self.w_3 = nn.Parameter(self.hidden_size, len(self.languages))
+        self._params = (self.w_1, self.w_3)
+
+        # Training graphs built on placeholders, one per word length, which
+        # train() re-runs with nn.run_and_backprop. They all write their loss
+        # into the same buffer.
+        self._graphs = {}
+        self._loss_scalar = np.empty((), dtype=np.float64)
 
     def run(self, xs):
         """
@@ -249,20 +352,11 @@ class LanguageIDModel(object):
             A node with shape (batch_size x 5) containing predicted scores
                 (also called logits)
         """
-        if self.batch_size == 0:
-            self.batch_size = xs[0].data.shape[0]
-
-        f = nn.ReLU(nn.Linear(xs[0], self.w_1))
-
-        for i in range(len(xs)):
-            if i == 0:
-                continue
-            else:
-                f = nn.ReLU(nn.Add(nn.Linear(xs[i], self.w_1), nn.Linear(f, self.w_2)))
+        f = nn.RecurrentReLU(xs, self.w_1)
 
         return nn.Linear(f, self.w_3)
 
-    def get_loss(self, xs, y):
+    def get_loss(self, xs, y, out=None):
         """
         Computes the loss for a batch of examples.
 
@@ -274,20 +368,31 @@ class LanguageIDModel(object):
             xs: a list with L elements (one per character), where each element
                 is a node with shape (batch_size x self.num_chars)
             y: a node with shape (batch_size x 5)
+            out: optional 0-dimensional array for the loss value (see
+                nn.SoftmaxLoss)
         Returns: a loss node
         """
-        return nn.SoftmaxLoss(self.run(xs), y)
+        return nn.SoftmaxLoss(self.run(xs), y, out=out)
 
     def train(self, dataset):
         """
         Trains the model.
         """
+        step = 0
         while True:
             for x, y in dataset.iterate_once(self.batch_size):
-                loss = self.get_loss(x, y)
-                origin = [self.w_1, self.w_2, self.w_3]
-                gradient = nn.gradients(loss, origin)
-                for i in range(len(origin)):
-                    origin[i].update(gradient[i], self.alpha)
-            if dataset.get_validation_accuracy() >= 0.83:
-                break
+                if len(x) not in self._graphs:
+                    xs = [nn.Placeholder(char.data) for char in x]
+                    labels = nn.Placeholder(y.data)
+                    self._graphs[len(x)] = (xs, labels, self.get_loss(
+                        xs, labels, out=self._loss_scalar))
+                xs, labels, loss = self._graphs[len(x)]
+                for placeholder, char in zip(xs, x):
+                    placeholder.data = char.data
+                labels.data = y.data
+                gradient = nn.run_and_backprop(loss, self._params)
+                nn.Parameter.batch_update(self._params, gradient, self.alpha)
+                step += 1
+                if (step % self.validation_interval == 0
+                        and dataset.get_validation_accuracy() >= 0.85):
+                    return
@@ -1,5 +1,7 @@
 import numpy as np
 
+import nn_kernels
+
 def format_shape(shape):
     return "x".join(map(str, shape)) if shape else "()"
 
@@ -57,6 +59,41 @@ class Parameter(DataNode):
         assert np.all(np.isfinite(self.data)), (
             "Parameter contains NaN or infinity after update, cannot continue")
 
+    @staticmethod
+    def batch_update(parameters, directions, multiplier):
+        """
+        Updates several parameters at once. This is equivalent to calling
+        `parameter.update(direction, multiplier)` for every pair, but checks
+        the arguments once for the whole batch.
+
+        Usage: nn.Parameter.batch_update(parameters, gradients, multiplier)
+        Inputs:
+            parameters: a list (or tuple) of Parameter nodes
+            directions: a list of Constant nodes, one per parameter, e.g. the
+                output of nn.gradients
+            multiplier: a Python scalar
+        """
+        assert len(parameters) == len(directions), (
+            "Got {} parameters but {} update directions".format(
+                len(parameters), len(directions)))
+        assert isinstance(multiplier, (int, float)), (
+            "Multiplier must be a Python scalar, instead has type {!r}".format(
+                type(multiplier).__name__))
+        assert all(isinstance(direction, Constant) for direction in directions), (
+            "Update directions must be {} nodes, instead got types {!r}".format(
+                Constant.__name__,
+                tuple(type(direction).__name__ for direction in directions)))
+        for parameter, direction in zip(parameters, directions):
+            assert direction.data.shape == parameter.data.shape, (
+                "Update direction shape {} does not match parameter shape "
+                "{}".format(
+                    format_shape(direction.data.shape),
+                    format_shape(parameter.data.shape)))
+            parameter.data += multiplier * direction.data
+        assert all(np.all(np.isfinite(parameter.data))
+                   for parameter in parameters), (
+            "Parameter contains NaN or infinity after update, cannot continue")
+
 class Constant(DataNode):
     """
     A Constant node is used to represent:
@@ -76,6 +113,18 @@ class Constant(DataNode):
                 data.dtype))
         super().__init__(data)
 
+class Placeholder(Constant):
+    """
+    A Placeholder node stands in for input features or labels in a graph that
+    is built once and then re-run on new data with nn.run_and_backprop.
+
+    Usage: nn.Placeholder(data)
+    Input:
+        data: a float numpy array used for the first run of the graph. Before
+            each later run, assign a new array with the same shape to the
+            node's `data` attribute.
+    """
+
 class FunctionNode(Node):
     """
     A FunctionNode represents a value that is computed based on other nodes.
@@ -220,6 +269,162 @@ class Linear(FunctionNode):
         assert gradient.shape[1] == inputs[1].shape[1]
         return [np.dot(gradient, inputs[1].T), np.dot(inputs[0].T, gradient)]
 
+class LinearBiasReLU(FunctionNode):
+    """
+    Applies a linear transformation, adds a bias vector and then applies a
+    ReLU, all in one node: max(features * weights + bias, 0). This computes the
+    same thing as nn.ReLU(nn.AddBias(nn.Linear(features, weights), bias))
+    without creating the two intermediate nodes.
+
+    Usage: nn.LinearBiasReLU(features, weights, bias, out=None, mask=None)
+    Inputs:
+        features: a Node with shape (batch_size x input_features)
+        weights: a Node with shape (input_features x output_features)
+        bias: a Node with shape (1 x output_features)
+        out: optional float64 array of shape (batch_size x output_features)
+            to write the output into instead of allocating a new one
+        mask: optional bool array with the same shape as the output, used for
+            the activation mask that is kept for backpropagation
+    Output: a node with shape (batch_size x output_features), but no negative
+        entries
+
+    Note that reusing `out` and `mask` overwrites the values of any earlier
+    node that was given the same buffers.
+    """
+    def __init__(self, features, weights, bias, out=None, mask=None):
+        self.out = out
+        self.mask = mask
+        super().__init__(features, weights, bias)
+
+    def _forward(self, *inputs):
+        assert len(inputs) == 3, "Expected 3 inputs, got {}".format(len(inputs))
+        assert all(inp.ndim == 2 for inp in inputs), (
+            "Inputs should have 2 dimensions, instead have {}".format(
+                tuple(inp.ndim for inp in inputs)))
+        assert inputs[0].shape[1] == inputs[1].shape[0], (
+            "Second dimension of first input should match first dimension of "
+            "second input, instead got shapes {} and {}".format(
+                format_shape(inputs[0].shape), format_shape(inputs[1].shape)))
+        assert inputs[2].shape == (1, inputs[1].shape[1]), (
+            "Bias should have shape 1x{}, instead got shape {}".format(
+                inputs[1].shape[1], format_shape(inputs[2].shape)))
+        shape = (inputs[0].shape[0], inputs[1].shape[1])
+        if self.out is None:
+            out = np.dot(inputs[0], inputs[1])
+        else:
+            assert self.out.shape == shape, (
+                "Output buffer should have shape {}, instead got shape "
+                "{}".format(format_shape(shape), format_shape(self.out.shape)))
+            out = np.dot(inputs[0], inputs[1], out=self.out)
+        if self.mask is None:
+            self.mask = np.empty(shape, dtype=bool)
+        assert self.mask.shape == shape, (
+            "Mask buffer should have shape {}, instead got shape {}".format(
+                format_shape(shape), format_shape(self.mask.shape)))
+        # The output is positive exactly where the pre-activation was, so the
+        # mask is all backward needs to skip recomputing the matmul.
+        if nn_kernels.usable(out, inputs[2]):
+            nn_kernels.bias_relu_fwd(out, inputs[2], self.mask)
+        else:
+            out += inputs[2]
+            np.maximum(out, 0, out=out)
+            np.greater(out, 0, out=self.mask)
+        return out
+
+    def _backward(self, gradient, *inputs):
+        assert gradient.shape == self.mask.shape
+        # `gradient` is the buffer nn.gradients accumulated for this node only,
+        # so it can be masked in place.
+        if nn_kernels.usable(gradient):
+            bias_gradient = np.empty((1, gradient.shape[1]))
+            nn_kernels.bias_relu_bwd(gradient, self.mask, bias_gradient)
+        else:
+            gradient *= self.mask
+            bias_gradient = np.sum(gradient, axis=0, keepdims=True)
+        return [
+            np.dot(gradient, inputs[1].T),
+            np.dot(inputs[0].T, gradient),
+            bias_gradient
+        ]
+
+class RecurrentReLU(FunctionNode):
+    """
+    Runs a recurrent network with a ReLU nonlinearity over a sequence of
+    inputs, and returns its final hidden state. Starting from h = 0, each step
+    computes
+        h = max(xs[t] * w_x + h * w_h, 0)
+    where w_x is made of the first input_features rows of `weights` and w_h of
+    the remaining rows. The input terms xs[t] * w_x of all steps are computed
+    up front with a single batched matrix multiplication, so only h * w_h is
+    left inside the loop over time.
+
+    Usage: nn.RecurrentReLU(xs, weights)
+    Inputs:
+        xs: a list of L Nodes, each with shape (batch_size x input_features)
+        weights: a Node with shape
+            ((input_features + hidden_size) x hidden_size)
+    Output: a Node with shape (batch_size x hidden_size)
+    """
+    def __init__(self, xs, weights):
+        super().__init__(weights, *xs)
+
+    def _forward(self, *inputs):
+        assert len(inputs) >= 2, (
+            "Expected weights and at least 1 input, got {} inputs".format(
+                len(inputs)))
+        assert all(inp.ndim == 2 for inp in inputs), (
+            "Inputs should have 2 dimensions, instead have {}".format(
+                tuple(inp.ndim for inp in inputs)))
+        assert all(inp.shape == inputs[1].shape for inp in inputs[1:]), (
+            "All sequence inputs should have the same shape, instead got "
+            "shapes {}".format(
+                tuple(format_shape(inp.shape) for inp in inputs[1:])))
+        weights = inputs[0]
+        split = inputs[1].shape[1]
+        assert weights.shape[0] == split + weights.shape[1], (
+            "Weights should have shape {}x{}, instead got shape {}".format(
+                split + weights.shape[1], weights.shape[1],
+                format_shape(weights.shape)))
+        self.xs = np.stack(inputs[1:])
+        # Starts out as the input terms of every step and is overwritten,
+        # step by step, with the hidden states
+        hidden = np.matmul(self.xs, weights[:split])
+        self.mask = np.empty(hidden.shape, dtype=bool)
+        for t in range(hidden.shape[0]):
+            if t > 0:
+                hidden[t] += np.dot(hidden[t - 1], weights[split:])
+            if nn_kernels.usable(hidden):
+                nn_kernels.relu_fwd(hidden[t], self.mask[t])
+            else:
+                np.maximum(hidden[t], 0, out=hidden[t])
+                np.greater(hidden[t], 0, out=self.mask[t])
+        self.hidden = hidden
+        return hidden[-1]
+
+    def _backward(self, gradient, *inputs):
+        assert gradient.shape == self.hidden.shape[1:]
+        weights = inputs[0]
+        steps, batch_size, hidden_size = self.hidden.shape
+        split = self.xs.shape[2]
+        # Backpropagate through time to get the gradient with respect to the
+        # pre-activation of every step
+        pre_grad = np.empty_like(self.hidden)
+        for t in reversed(range(steps)):
+            np.multiply(gradient, self.mask[t], out=pre_grad[t])
+            if t > 0:
+                gradient = np.dot(pre_grad[t], weights[split:].T)
+        # Every step shares the same weights, so their gradients are sums over
+        # all steps, each computed with one matrix multiplication
+        weights_grad = np.empty_like(weights)
+        weights_grad[:split] = np.dot(
+            self.xs.reshape(-1, split).T,
+            pre_grad.reshape(-1, hidden_size))
+        weights_grad[split:] = np.dot(
+            self.hidden[:-1].reshape(-1, hidden_size).T,
+            pre_grad[1:].reshape(-1, hidden_size))
+        xs_grad = np.matmul(pre_grad, weights[:split].T)
+        return [weights_grad] + list(xs_grad)
+
 class ReLU(FunctionNode):
     """
     An element-wise Rectified Linear Unit nonlinearity: max(x, 0).
@@ -249,14 +454,19 @@ class SquareLoss(FunctionNode):
     in the inputs, which creates a (batch_size x dim) matrix. It then calculates
     and returns the mean of all elements in this matrix.
 
-    Usage: nn.SquareLoss(a, b)
+    Usage: nn.SquareLoss(a, b, out=None)
     Inputs:
         a: a Node with shape (batch_size x dim)
         b: a Node with shape (batch_size x dim)
+        out: optional 0-dimensional float64 array to write the loss into
+            instead of allocating a new one
     Output: a scalar Node (containing a single floating-point number)
     """
-    @staticmethod
-    def _forward(*inputs):
+    def __init__(self, a, b, out=None):
+        self.out = out
+        super().__init__(a, b)
+
+    def _forward(self, *inputs):
         assert len(inputs) == 2, "Expected 2 inputs, got {}".format(len(inputs))
         assert inputs[0].ndim == 2, (
             "First input should have 2 dimensions, instead has {}".format(
@@ -267,7 +477,7 @@ class SquareLoss(FunctionNode):
         assert inputs[0].shape == inputs[1].shape, (
             "Input shapes should match, instead got {} and {}".format(
                 format_shape(inputs[0].shape), format_shape(inputs[1].shape)))
-        return np.mean(np.square(inputs[0] - inputs[1]) / 2)
+        return _store_loss(np.mean(np.square(inputs[0] - inputs[1]) / 2), self.out)
 
     @staticmethod
     def _backward(gradient, *inputs):
@@ -283,7 +493,7 @@ class SoftmaxLoss(FunctionNode):
 
     IMPORTANT: do not swap the order of the inputs to this node!
 
-    Usage: nn.SoftmaxLoss(logits, labels)
+    Usage: nn.SoftmaxLoss(logits, labels, out=None)
     Inputs:
         logits: a Node with shape (batch_size x num_classes). Each row
             represents the scores associated with that example belonging to a
@@ -291,16 +501,25 @@ class SoftmaxLoss(FunctionNode):
         labels: a Node with shape (batch_size x num_classes) that encodes the
             correct labels for the examples. All entries must be non-negative
             and the sum of values along each row should be 1.
+        out: optional 0-dimensional float64 array to write the loss into
+            instead of allocating a new one
     Output: a scalar Node (containing a single floating-point number)
     """
+    def __init__(self, logits, labels, out=None):
+        self.out = out
+        super().__init__(logits, labels)
+
     @staticmethod
     def log_softmax(logits):
+        if nn_kernels.usable(logits):
+            log_probs = np.empty_like(logits)
+            nn_kernels.log_softmax(logits, log_probs)
+            return log_probs
         log_probs = logits - np.max(logits, axis=1, keepdims=True)
         log_probs -= np.log(np.sum(np.exp(log_probs), axis=1, keepdims=True))
         return log_probs
 
-    @staticmethod
-    def _forward(*inputs):
+    def _forward(self, *inputs):
         assert len(inputs) == 2, "Expected 2 inputs, got {}".format(len(inputs))
         assert inputs[0].ndim == 2, (
             "First input should have 2 dimensions, instead has {}".format(
@@ -315,18 +534,29 @@ class SoftmaxLoss(FunctionNode):
             "All entries in the labels input must be non-negative")
         assert np.allclose(np.sum(inputs[1], axis=1), 1), (
             "Labels input must sum to 1 along each row")
-        log_probs = SoftmaxLoss.log_softmax(inputs[0])
-        return np.mean(-np.sum(inputs[1] * log_probs, axis=1))
+        # Kept for backpropagation, which needs the same log-probabilities
+        self.log_probs = SoftmaxLoss.log_softmax(inputs[0])
+        return _store_loss(
+            np.mean(-np.sum(inputs[1] * self.log_probs, axis=1)), self.out)
 
-    @staticmethod
-    def _backward(gradient, *inputs):
+    def _backward(self, gradient, *inputs):
         assert np.asarray(gradient).ndim == 0
-        log_probs = SoftmaxLoss.log_softmax(inputs[0])
+        log_probs = self.log_probs
         return [
             gradient * (np.exp(log_probs) - inputs[1]) / inputs[0].shape[0],
             gradient * -log_probs / inputs[0].shape[0]
         ]
 
+def _store_loss(loss, out):
+    if out is None:
+        return loss
+    assert out.shape == () and out.dtype == np.float64, (
+        "Loss output buffer should be a 0-dimensional float64 array, instead "
+        "got shape {} and data type {!r}".format(
+            format_shape(out.shape), out.dtype))
+    out[...] = loss
+    return out
+
 def gradients(loss, parameters):
     """
     Computes and returns the gradient of the loss with respect to the provided
@@ -352,6 +582,45 @@ def gradients(loss, parameters):
 
     loss.used = True
 
+    return _backpropagate(loss, _topological_order(loss), parameters)
+
+def run_and_backprop(loss, parameters):
+    """
+    Re-runs a graph that was built once on Placeholder nodes, then computes
+    and returns the gradient of the loss with respect to the provided
+    parameters.
+
+    Every node in the graph is recomputed from the current data of its
+    parents, so assign new arrays to the placeholders' `data` before each
+    call. Afterwards `loss` holds the new loss value. Unlike nn.gradients,
+    the same loss node can be used any number of times.
+
+    Usage: nn.run_and_backprop(loss, parameters)
+    Inputs:
+        loss: a SquareLoss or SoftmaxLoss node
+        parameters: a list (or iterable) containing Parameter nodes
+    Output: a list of Constant objects, representing the gradient of the loss
+        with respect to each provided parameter.
+    """
+
+    assert isinstance(loss, (SquareLoss, SoftmaxLoss)), (
+        "Loss must be a loss node, instead has type {!r}".format(
+            type(loss).__name__))
+    assert all(isinstance(parameter, Parameter) for parameter in parameters), (
+        "Parameters must all have type {}, instead got types {!r}".format(
+            Parameter.__name__,
+            tuple(type(parameter).__name__ for parameter in parameters)))
+
+    if not hasattr(loss, "tape"):
+        loss.tape = _topological_order(loss)
+
+    for node in loss.tape:
+        if isinstance(node, FunctionNode):
+            node.data = node._forward(*(parent.data for parent in node.parents))
+
+    return _backpropagate(loss, loss.tape, parameters)
+
+def _topological_order(loss):
     nodes = set()
     tape = []
 
@@ -363,7 +632,10 @@ def gradients(loss, parameters):
             tape.append(node)
 
     visit(loss)
-    nodes |= set(parameters)
+    return tape
+
+def _backpropagate(loss, tape, parameters):
+    nodes = set(tape) | set(parameters)
 
     grads = {node: np.zeros_like(node.data) for node in nodes}
     grads[loss] = 1.0
@@ -0,0 +1,160 @@
+"""
+Numba-compiled kernels for the elementwise parts of some nodes in nn.py.
+
+The matrix multiplications stay in numpy, which hands them to BLAS. These
+kernels replace the chains of small numpy calls that follow them (bias, ReLU,
+mask, softmax) with a single compiled loop each. Numba is optional: if it is
+not installed, `enabled` is False and nn.py uses its plain numpy code paths.
+
+DigitClassificationModel also uses mlp_softmax_gradients directly for its
+training step. You should not need to use this module directly otherwise.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+enabled = numba is not None
+
+if enabled:
+    @numba.njit(cache=True, fastmath=True)
+    def relu_fwd(z, mask):
+        """Applies max(z, 0) in place and records where z was positive."""
+        for i in range(z.shape[0]):
+            for j in range(z.shape[1]):
+                if z[i, j] > 0.0:
+                    mask[i, j] = True
+                else:
+                    z[i, j] = 0.0
+                    mask[i, j] = False
+
+    @numba.njit(cache=True, fastmath=True)
+    def bias_relu_fwd(z, b, mask):
+        """Applies max(z + b, 0) in place and records where it was positive."""
+        for i in range(z.shape[0]):
+            for j in range(z.shape[1]):
+                v = z[i, j] + b[0, j]
+                if v > 0.0:
+                    z[i, j] = v
+                    mask[i, j] = True
+                else:
+                    z[i, j] = 0.0
+                    mask[i, j] = False
+
+    @numba.njit(cache=True, fastmath=True)
+    def bias_relu_bwd(gradient, mask, bias_gradient):
+        """
+        Zeroes `gradient` in place wherever `mask` is False, and writes the
+        column sums of the result into `bias_gradient`.
+        """
+        bias_gradient[:] = 0.0
+        for i in range(gradient.shape[0]):
+            for j in range(gradient.shape[1]):
+                if mask[i, j]:
+                    bias_gradient[0, j] += gradient[i, j]
+                else:
+                    gradient[i, j] = 0.0
+
+    @numba.njit(cache=True)
+    def log_softmax(logits, out):
+        """Writes the row-wise log-softmax of `logits` into `out`."""
+        for i in range(logits.shape[0]):
+            row_max = logits[i, 0]
+            for j in range(1, logits.shape[1]):
+                row_max = max(row_max, logits[i, j])
+            total = 0.0
+            for j in range(logits.shape[1]):
+                total += np.exp(logits[i, j] - row_max)
+            shift = row_max + np.log(total)
+            for j in range(logits.shape[1]):
+                out[i, j] = logits[i, j] - shift
+
+    # Compiled on its first call rather than at import, since only
+    # DigitClassificationModel.train uses it
+    @numba.njit(cache=True, fastmath=True)
+    def mlp_softmax_gradients(x, y, w_1, b_1, w_2, b_2,
+                              grad_w_1, grad_b_1, grad_w_2, grad_b_2):
+        """
+        Computes the gradients of
+            SoftmaxLoss(AddBias(Linear(LinearBiasReLU(x, w_1, b_1), w_2), b_2), y)
+        with respect to w_1, b_1, w_2 and b_2, and writes them into the
+        grad_* arrays. The matrix products are written out as loops (Numba
+        only calls BLAS when SciPy is installed), skipping the zero entries
+        of x, which make up most of an MNIST image.
+        """
+        batch_size, input_size = x.shape
+        hidden_size = w_1.shape[1]
+        output_size = w_2.shape[1]
+
+        hidden = np.empty((batch_size, hidden_size))
+        for i in range(batch_size):
+            hidden[i, :] = b_1[0, :]
+            for p in range(input_size):
+                if x[i, p] != 0.0:
+                    for j in range(hidden_size):
+                        hidden[i, j] += x[i, p] * w_1[p, j]
+            for j in range(hidden_size):
+                hidden[i, j] = max(hidden[i, j], 0.0)
+
+        # Gradient of the mean softmax loss with respect to the logits
+        grad_logits = np.empty((batch_size, output_size))
+        for i in range(batch_size):
+            for k in range(output_size):
+                total = b_2[0, k]
+                for j in range(hidden_size):
+                    total += hidden[i, j] * w_2[j, k]
+                grad_logits[i, k] = total
+            row_max = grad_logits[i, 0]
+            for k in range(1, output_size):
+                row_max = max(row_max, grad_logits[i, k])
+            total = 0.0
+            for k in range(output_size):
+                grad_logits[i, k] = np.exp(grad_logits[i, k] - row_max)
+                total += grad_logits[i, k]
+            for k in range(output_size):
+                grad_logits[i, k] = (
+                    grad_logits[i, k] / total - y[i, k]) / batch_size
+
+        grad_w_2[:] = 0.0
+        grad_b_2[:] = 0.0
+        grad_hidden = np.empty((batch_size, hidden_size))
+        for i in range(batch_size):
+            for k in range(output_size):
+                grad_b_2[0, k] += grad_logits[i, k]
+            for j in range(hidden_size):
+                total = 0.0
+                for k in range(output_size):
+                    grad_w_2[j, k] += hidden[i, j] * grad_logits[i, k]
+                    total += grad_logits[i, k] * w_2[j, k]
+                grad_hidden[i, j] = total if hidden[i, j] > 0.0 else 0.0
+
+        grad_w_1[:] = 0.0
+        grad_b_1[:] = 0.0
+        for i in range(batch_size):
+            for j in range(hidden_size):
+                grad_b_1[0, j] += grad_hidden[i, j]
+            for p in range(input_size):
+                if x[i, p] != 0.0:
+                    for j in range(hidden_size):
+                        grad_w_1[p, j] += x[i, p] * grad_hidden[i, j]
+
+    # Compile (or load from the on-disk cache) now, so that the first training
+    # step does not pay for it
+    _z = np.zeros((1, 1))
+    _mask = np.zeros((1, 1), dtype=np.bool_)
+    relu_fwd(_z, _mask)
+    bias_relu_fwd(_z, np.zeros((1, 1)), _mask)
+    bias_relu_bwd(_z, _mask, np.zeros((1, 1)))
+    log_softmax(_z, np.empty((1, 1)))
+    del _z, _mask
+
+def usable(*arrays):
+    """
+    Returns True if the kernels are available and can be run directly on all
+    of the given float arrays (float64 and C-contiguous).
+    """
+    return enabled and all(
+        array.dtype == np.float64 and array.flags.c_contiguous
+        for array in arrays)